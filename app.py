@@ -1,26 +1,110 @@
 import asyncio
 import logging
 import os
+import socket
 import sys
 from typing import Awaitable, Callable
 
-import dotenv
-import uvicorn
-from fastapi import FastAPI, Request, Response
-from uvicorn.logging import DefaultFormatter
-
-from discordbot import bot, bot_invitation_link
+from boot_profile import BootProfile
 
+# imported after the port is bound. see load_bot()
+discordbot = None
 
+profile = BootProfile()
 logger = logging.getLogger("amongus_admin")
-app = FastAPI()
 
 
-@app.middleware("http")
-async def catch_all(request: Request, _call_next: Callable[[Request], Awaitable[Response]]):
-    if request.url.path in ["/ping", "/health_check", "/poke"]:
-        return Response(status_code=200)
-    return Response(status_code=302, headers={"Location": bot_invitation_link})
+def create_app():
+    from fastapi import FastAPI, Request, Response
+    from fastapi.responses import JSONResponse
+
+    app = FastAPI()
+
+    @app.middleware("http")
+    async def catch_all(request: Request, _call_next: Callable[[Request], Awaitable[Response]]):
+        if request.url.path in ["/ping", "/health_check", "/poke"]:
+            return Response(status_code=200)
+        if request.url.path == "/stats":
+            stats = {"boot": profile.as_dict()}
+            if discordbot:
+                stats["voice_events"] = discordbot.voice_event_filter.stats()
+                stats["transitions"] = discordbot.transition_stats.as_dict()
+            return JSONResponse(stats)
+        if not discordbot:
+            return Response(status_code=503, headers={"Retry-After": "1"})
+        return Response(status_code=302, headers={"Location": discordbot.bot_invitation_link})
+
+    return app
+
+
+def _bind_socket(port: int) -> socket.socket:
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(("0.0.0.0", port))
+    # accept connections into the backlog until uvicorn starts serving
+    sock.listen(128)
+    sock.set_inheritable(True)
+    return sock
+
+
+def _import_discord():
+    # no event loop in the executor thread, so only modules that don't construct clients on import
+    import discord.ext.commands  # noqa: F401
+
+
+async def load_bot(server):
+    """
+    import the discord client and the session subsystem once the health endpoints are served, then connect.
+    discord.py is imported in an executor so uvicorn keeps answering health checks meanwhile,
+    and only discordbot, which builds the Bot on the event loop, is imported on the loop.
+
+    :param server: uvicorn.Server
+    :return:
+    """
+    global discordbot
+    while not server.started:
+        await asyncio.sleep(0.01)
+    profile.mark("healthy")
+    with profile.importing("discord"):
+        await asyncio.get_event_loop().run_in_executor(None, _import_discord)
+    with profile.importing("discordbot"):
+        import discordbot
+    bot = discordbot.bot
+    bot.loop = asyncio.get_event_loop()
+
+    async def on_gateway_ready():
+        if "gateway_ready" not in profile.marks:
+            profile.mark("gateway_ready")
+            logger.info(profile)
+
+    bot.add_listener(on_gateway_ready, "on_ready")
+    try:
+        await bot.start(os.environ["DISCORD_BOT_TOKEN"])
+    finally:
+        if not bot.is_closed():
+            await bot.close()
+
+
+def _stop_server_with_bot(server):
+    """
+    a web dyno without the bot is useless, so stop serving health checks when the bot stops
+    and let the platform restart the process
+
+    :param server: uvicorn.Server
+    :return:
+    """
+
+    def callback(task: asyncio.Task):
+        if task.cancelled() or server.should_exit:
+            return
+        error = task.exception()
+        if error:
+            logger.error("The discord client failed, shutting down.", exc_info=error)
+        else:
+            logger.error("The discord client stopped, shutting down.")
+        server.should_exit = True
+
+    return callback
 
 
 def _cancel_tasks(loop):
@@ -61,26 +145,37 @@ def _cleanup_loop(loop):
 
 
 if __name__ == "__main__":
+    import dotenv
+
     dotenv.load_dotenv(".env")
+    port = int(os.environ.get("PORT", 5000))
+    server_socket = _bind_socket(port)
+    profile.mark("bound")
+
+    with profile.importing("uvicorn"):
+        import uvicorn
+        from uvicorn.logging import DefaultFormatter
     root_handler = logging.StreamHandler(sys.stderr)
     fmt = "%(levelprefix)s [%(name)s]\t%(message)s"
     root_handler.setFormatter(DefaultFormatter(fmt=fmt))
     # noinspection PyArgumentList
     logging.basicConfig(level=logging.DEBUG, handlers=[root_handler])
 
+    with profile.importing("fastapi"):
+        app = create_app()
+
     main_loop = asyncio.get_event_loop()
     asyncio.set_event_loop(main_loop)
-    bot.loop = main_loop
-
-    async def bot_runner(*args, **kwargs):
-        try:
-            await bot.start(*args, **kwargs)
-        finally:
-            if not bot.is_closed():
-                await bot.close()
 
-    asyncio.ensure_future(bot_runner(os.environ["DISCORD_BOT_TOKEN"]))
-    port = int(os.environ.get("PORT", 5000))
-    uvicorn.run(app, host="0.0.0.0", port=port, reload=False, workers=1, loop="none", log_config=None)
-    main_loop.run_until_complete(bot.close())
+    config = uvicorn.Config(app, host="0.0.0.0", port=port, reload=False, workers=1, loop="none", log_config=None)
+    server = uvicorn.Server(config)
+    bot_task = asyncio.ensure_future(load_bot(server))
+    bot_task.add_done_callback(_stop_server_with_bot(server))
+    server.run(sockets=[server_socket])
+    # finished before the server was asked to stop, so it failed
+    bot_failed = bot_task.done() and not bot_task.cancelled()
+    if discordbot:
+        main_loop.run_until_complete(discordbot.bot.close())
     _cleanup_loop(main_loop)
+    if bot_failed:
+        sys.exit(1)
@@ -0,0 +1,55 @@
+import sys
+import time
+from contextlib import contextmanager
+from typing import Dict, Tuple
+
+
+class BootProfile:
+    """
+    wall clock timings of the startup phases, measured from the creation of the profile
+    """
+
+    started_at: float
+    marks: Dict[str, float]
+    imports: Dict[str, Tuple[float, int]]
+
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self.marks = {}
+        self.imports = {}
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.started_at
+
+    def mark(self, name: str):
+        self.marks[name] = self.elapsed()
+
+    @contextmanager
+    def importing(self, name: str):
+        """
+        measure an import group: seconds taken and number of modules newly loaded
+
+        :param name:
+        :return:
+        """
+        modules = len(sys.modules)
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.imports[name] = (time.perf_counter() - started_at, len(sys.modules) - modules)
+
+    def as_dict(self) -> dict:
+        return {
+            "marks": self.marks,
+            "imports": {
+                name: {"seconds": seconds, "modules": count} for name, (seconds, count) in self.imports.items()
+            },
+        }
+
+    def __str__(self):
+        marks = ", ".join(f"{name}: {elapsed:.3f}s" for name, elapsed in self.marks.items())
+        imports = ", ".join(
+            f"{name}: {seconds:.3f}s/{count} modules" for name, (seconds, count) in self.imports.items()
+        )
+        return f"boot ({marks}) imports ({imports})"
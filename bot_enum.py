@@ -13,3 +13,9 @@ class ActionReaction(str, Enum):
 class AmongUsSessionStatus(int, Enum):
     ALIVE = 0
     DEAD = 1
+
+
+class AmongUsSessionPhase(int, Enum):
+    LOBBY = 0
+    MUTE = 1
+    EMERGENCY = 2
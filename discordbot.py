@@ -18,8 +18,10 @@ import dotenv
 from discord.abc import Messageable
 from discord.ext.commands import Context, Bot
 
-from bot_enum import ActionReaction, AmongUsSessionStatus
-from localization import Localized, English, Japanese
+from bot_enum import ActionReaction, AmongUsSessionPhase, AmongUsSessionStatus
+from gateway_filter import VoiceEventFilter
+from voice_moves import TransitionReport, TransitionStats, VoiceMove, voice_target
+from localization import Localized, get_locale
 
 logger = logging.getLogger("amongus_admin")
 
@@ -31,6 +33,7 @@ bot_invitation_link = (
     f"https://discord.com/oauth2/authorize?client_id=802513262854799390&permissions="
     f"{base_permissions.value}&scope=bot"
 )
+transition_stats = TransitionStats()
 
 
 async def async_nop():
@@ -76,8 +79,6 @@ class AmongUsSession:
         :param member:
         :return:
         """
-        messages = []
-        reactions = set()
         is_admin = self.admin == member
         if self.deleting or (member not in self.members and member in self.member_messages):
             message_to_delete = self.member_messages[member]
@@ -87,25 +88,13 @@ class AmongUsSession:
             await message_to_delete.delete()
             await reaction_to_delete.delete()
         else:
-            header_message = self.manager.locale.create_message if is_admin else self.manager.locale.join_message
-            messages.append(header_message.format(name=member.display_name, session_id=self.id))
-            if not self.started and is_admin:
-                messages.append(self.manager.locale.ready_message)
-                reactions.add(ActionReaction.START)
-                reactions.add(ActionReaction.CLOSE)
-            if self.started:
-                messages.append(self.manager.locale.start_message.format(session_id=self.id))
-                if is_admin:
-                    messages.append(self.manager.locale.start_message_admin)
-                    reactions.add(ActionReaction.MUTE if self.is_emergency else ActionReaction.GATHER)
-                    reactions.add(ActionReaction.STOP)
-                if self.status[member] == AmongUsSessionStatus.DEAD:
-                    messages.append(self.manager.locale.dead_message)
-                else:
-                    reactions.add(ActionReaction.DEAD)
+            template, panel_reactions = self.manager.locale.render_panel(
+                is_admin, self.phase, self.status.get(member, AmongUsSessionStatus.ALIVE)
+            )
+            reactions = set(panel_reactions)
 
             async def inner():
-                target_message = "\n".join(messages)
+                target_message = template.format(name=member.display_name, session_id=self.id)
                 if member not in self.member_messages:
                     self.member_messages[member] = await member.send(target_message)
                 else:
@@ -140,6 +129,25 @@ class AmongUsSession:
 
             await inner()
 
+    def watches(self, channel_id: Optional[int], user_id: int) -> bool:
+        """
+        whether a voice state update is relevant to the session
+
+        :param channel_id: channel the user is now in
+        :param user_id:
+        :return:
+        """
+        channels = (self.lobby, self.emergency, self.mute, self.graveyard)
+        if channel_id is not None and any(channel and channel.id == channel_id for channel in channels):
+            return True
+        return any(member.id == user_id for member in self.members)
+
+    @property
+    def phase(self) -> AmongUsSessionPhase:
+        if not self.started:
+            return AmongUsSessionPhase.LOBBY
+        return AmongUsSessionPhase.EMERGENCY if self.is_emergency else AmongUsSessionPhase.MUTE
+
     async def prepare_vc(self):
         """
         set Session's vc
@@ -177,45 +185,112 @@ class AmongUsSession:
             tasks.append(create_graveyard())
         await asyncio.gather(*tasks)
 
-    async def try_edit(self, member: Member, vc: Optional[VoiceChannel], mute: bool, deafen: bool):
+    async def try_edit(
+        self,
+        member: Member,
+        vc: Optional[VoiceChannel],
+        mute: bool,
+        deafen: bool,
+        transition: Optional[TransitionReport] = None,
+    ):
         if not hasattr(member, "guild"):
             member = self.manager.guild.get_member(member.id)
         logger.debug(
             f"try edit {member.display_name} @ {member.guild.name}"
             f" -> vc: {vc and vc.name} mute: {mute} deafen: {deafen}"
         )
-        target_voice = VoiceState(data=dict(mute=mute, deafen=deafen), channel=vc)
-        voice_state: VoiceState = member.voice
-        if not voice_state or not voice_state.channel:
-            return
-        if voice_state == target_voice:
-            return
-        await asyncio.create_task(
-            member.edit(voice_channel=target_voice.channel, mute=target_voice.mute, deafen=target_voice.deaf)
-        )
 
-    async def set_vc(self, member: Member):
+        def on_sent():
+            if transition:
+                transition.mark_sent(member.id)
+
+        # a move still in flight may land after this check, so it's superseded first
+        # and the cached state can't be trusted to skip the edit
+        previous_move = self.manager.pending_moves.pop(member.id, None)
+        if previous_move:
+            previous_move.supersede()
+        move = VoiceMove(member.id, (vc and vc.id, mute, deafen))
+        if not previous_move and move.matches(voice_target(member.voice)):
+            on_sent()
+            return
+        self.manager.pending_moves[member.id] = move
+        ok = False
+        try:
+            ok = await move.run(
+                lambda: member.edit(voice_channel=vc, mute=mute, deafen=deafen),
+                lambda: voice_target(member.voice),
+                on_sent,
+            )
+        finally:
+            on_sent()
+            # the member is still away from voice: keep the move so the target is re-applied on reconnect
+            move.parked = not ok and not move.superseded and not move.connected.is_set()
+            if self.manager.pending_moves.get(member.id) is move and not move.parked:
+                del self.manager.pending_moves[member.id]
+        if transition and not move.superseded:
+            transition.record(member.id, move, ok)
+
+    async def set_vc(self, member: Member, transition: Optional[TransitionReport] = None):
         """
         set Member's channel
 
         :param member:
+        :param transition: report to record the time to convergence into
         :return:
         """
         if self.deleting:
-            await self.try_edit(member, vc=None, mute=False, deafen=False)
+            await self.try_edit(member, vc=None, mute=False, deafen=False, transition=transition)
         else:
             if not self.started:
-                await self.try_edit(member, vc=self.lobby, mute=False, deafen=False)
+                await self.try_edit(member, vc=self.lobby, mute=False, deafen=False, transition=transition)
             else:
                 if self.is_emergency:
                     await self.try_edit(
-                        member, vc=self.emergency, mute=self.status[member] == AmongUsSessionStatus.DEAD, deafen=False
+                        member,
+                        vc=self.emergency,
+                        mute=self.status[member] == AmongUsSessionStatus.DEAD,
+                        deafen=False,
+                        transition=transition,
                     )
                 else:
                     if self.status[member] == AmongUsSessionStatus.ALIVE:
-                        await self.try_edit(member, vc=self.mute, mute=True, deafen=True)
+                        await self.try_edit(member, vc=self.mute, mute=True, deafen=False, transition=transition)
                     if self.status[member] == AmongUsSessionStatus.DEAD:
-                        await self.try_edit(member, vc=self.graveyard, mute=False, deafen=False)
+                        await self.try_edit(
+                            member, vc=self.graveyard, mute=False, deafen=False, transition=transition
+                        )
+
+    async def converge(self, name: str, members: List[Member]):
+        """
+        set members' channel. Returns once every edit request was sent, while the confirmations
+        are tracked in the background to report how long it took until every move was confirmed
+
+        :param name: name of the transition
+        :param members:
+        :return:
+        """
+        transition = TransitionReport(name, [member.id for member in members])
+
+        async def track():
+            try:
+                results = await asyncio.gather(
+                    *[self.set_vc(member, transition) for member in members], return_exceptions=True
+                )
+                for member, result in zip(members, results):
+                    if isinstance(result, Exception):
+                        logger.error(
+                            f"failed to set vc of {member.id}: {self.id} @ {self.manager.guild.name}", exc_info=result
+                        )
+                        transition.failed.append(member.id)
+            finally:
+                transition.finish()
+                transition_stats.add(transition)
+                logger.info(f"{transition}: {self.id} @ {self.manager.guild.name}")
+
+        tracking = asyncio.create_task(track())
+        all_sent = asyncio.create_task(transition.all_sent.wait())
+        await asyncio.wait([tracking, all_sent], return_when=asyncio.FIRST_COMPLETED)
+        all_sent.cancel()
 
     async def clean_vc(self):
         """
@@ -250,14 +325,11 @@ class AmongUsSession:
             tasks.append(delete_graveyard())
         await asyncio.gather(*tasks)
 
-    async def set_interface(self, prepare_vc=True):
+    async def set_interface(self, transition_name: str, prepare_vc=True):
         async def vc_task():
             if prepare_vc:
                 await self.prepare_vc()
-            tasks = []
-            for member in self.members:
-                tasks.append(self.set_vc(member))
-            await asyncio.gather(*tasks)
+            await self.converge(transition_name, list(self.members))
             await self.clean_vc()
 
         async def message_task():
@@ -276,7 +348,7 @@ class AmongUsSession:
 
         async def interface_init():
             ins.lobby = await ins.manager.guild.create_voice_channel(f"{ins.manager.locale.lobby}-{ins.id}")
-            await ins.set_interface(prepare_vc=False)
+            await ins.set_interface("create", prepare_vc=False)
 
         async def public_message():
             await channel.send(ins.manager.locale.new_session.format(session_id=session_id))
@@ -292,7 +364,7 @@ class AmongUsSession:
         self.members.add(new_member)
         self.manager.member_sessions_idx[new_member] = self.id
         self.status[new_member] = AmongUsSessionStatus.ALIVE
-        asyncio.create_task(self.set_interface())
+        asyncio.create_task(self.set_interface("join"))
 
     async def leave(self, a_member: Member):
         if self.deleting or a_member not in self.members:
@@ -306,7 +378,7 @@ class AmongUsSession:
             del self.status[a_member]
         if self.manager.member_sessions_idx.get(a_member) == self.id:
             del self.manager.member_sessions_idx[a_member]
-        asyncio.create_task(self.set_interface())
+        asyncio.create_task(self.set_interface("leave"))
 
     async def dead(self, a_member: Member):
         if self.deleting or a_member not in self.members or self.status[a_member] == AmongUsSessionStatus.DEAD:
@@ -314,22 +386,22 @@ class AmongUsSession:
         logger.info(f"{a_member.display_name} is dead: {self.id} @ {self.manager.guild.name}")
         self.status[a_member] = AmongUsSessionStatus.DEAD
         if self.is_emergency:
-            asyncio.create_task(self.set_vc(a_member))
+            asyncio.create_task(self.converge("dead", [a_member]))
         asyncio.create_task(self.set_private_message(a_member))
 
-    async def end_emergency(self, member: Member, prepare_vc=False):
+    async def end_emergency(self, member: Member, prepare_vc=False, transition_name="end_emergency"):
         if self.deleting or member != self.admin:
             return
         self.is_emergency = False
         logger.info(f"end emergency: {self.id} @ {self.manager.guild.name}")
-        asyncio.create_task(self.set_interface(prepare_vc))
+        asyncio.create_task(self.set_interface(transition_name, prepare_vc))
 
     async def declare_emergency(self, member: Member):
         if self.deleting or member != self.admin or self.is_emergency:
             return
         self.is_emergency = True
         logger.info(f"declare emergency: {self.id} @ {self.manager.guild.name}")
-        asyncio.create_task(self.set_interface(prepare_vc=False))
+        asyncio.create_task(self.set_interface("emergency", prepare_vc=False))
 
     async def start(self, member: Member):
         if self.deleting or member != self.admin or self.started:
@@ -338,21 +410,21 @@ class AmongUsSession:
         self.status.update({_member: AmongUsSessionStatus.ALIVE for _member in self.status})
         admin = member
         logger.info(f"start session: {self.id} @ {self.manager.guild.name}")
-        await self.end_emergency(admin, prepare_vc=True)
+        await self.end_emergency(admin, prepare_vc=True, transition_name="start")
 
     async def end(self, member: Member):
         if self.deleting or member != self.admin or not self.started:
             return
         self.started = False
         logger.info(f"end session: {self.id} @ {self.manager.guild.name}")
-        asyncio.create_task(self.set_interface(prepare_vc=True))
+        asyncio.create_task(self.set_interface("end", prepare_vc=True))
 
     async def close(self, member: Member):
         if member != self.admin:
             return
         logger.info(f"close session: {self.id} @ {self.manager.guild.name}")
         self.deleting = True
-        asyncio.create_task(self.set_interface(prepare_vc=False))
+        asyncio.create_task(self.set_interface("close", prepare_vc=False))
 
 
 class AmongUsSessionManager:
@@ -362,16 +434,17 @@ class AmongUsSessionManager:
     locale: Localized
     sessions: Dict[str, AmongUsSession]
     member_sessions_idx: Dict[Member, str]
+    pending_moves: Dict[int, VoiceMove]
 
     def __init__(self, guild: Guild, session_prefix=None):
         logger.info(f"New Guild: {guild.name} ({guild.id})")
         self.guild = guild
-        self.locale = English()
-        self.set_locale(guild.preferred_locale)
+        self.locale = get_locale(guild.preferred_locale)
         self.sessions = {}
         self.session_counter = []
         self.session_prefix = session_prefix or self.session_prefix
         self.member_sessions_idx = {}
+        self.pending_moves = {}
 
     async def check_permissions(self, channel: Messageable, guild: Optional[Guild] = None) -> bool:
         guild: Guild = guild or self.guild
@@ -384,10 +457,7 @@ class AmongUsSessionManager:
         return sufficient
 
     def set_locale(self, locale):
-        if locale in ("ja", "ja_JP", "japanese", "日本語"):
-            self.locale = Japanese()
-        else:
-            self.locale = English()
+        self.locale = get_locale(locale)
 
     async def create_session(self, author: Member, channel: TextChannel):
         if not await self.check_permissions(channel):
@@ -425,6 +495,34 @@ class AmongUsSessionManager:
 
 
 managers: Dict[Guild, AmongUsSessionManager] = {}
+managers_by_id: Dict[int, AmongUsSessionManager] = {}
+
+
+def is_relevant_voice_state(data: dict) -> bool:
+    """
+    look at a raw VOICE_STATE_UPDATE payload and tell if any session needs it
+
+    :param data:
+    :return:
+    """
+    user_id = int(data["user_id"])
+    if bot.user and bot.user.id == user_id:
+        return True
+    guild_id = data.get("guild_id")
+    manager = guild_id and managers_by_id.get(int(guild_id))
+    if not manager:
+        return False
+    if user_id in manager.pending_moves:
+        return True
+    if not manager.sessions:
+        return False
+    channel_id = data.get("channel_id")
+    channel_id = channel_id and int(channel_id)
+    return any(session.watches(channel_id, user_id) for session in manager.sessions.values())
+
+
+voice_event_filter = VoiceEventFilter(is_relevant_voice_state)
+voice_event_filter.install(bot)
 
 
 async def get_manager(guild: Optional[Guild], author: User = None) -> Optional[AmongUsSessionManager]:
@@ -447,7 +545,7 @@ async def get_manager(guild: Optional[Guild], author: User = None) -> Optional[A
             await guild.leave()
         ok: bool
         if not manager:
-            manager = managers[guild] = AmongUsSessionManager(guild)
+            manager = managers[guild] = managers_by_id[guild.id] = AmongUsSessionManager(guild)
             ok = await manager.check_permissions(target_channel, guild)
         else:
             manager.guild = guild
@@ -456,6 +554,7 @@ async def get_manager(guild: Optional[Guild], author: User = None) -> Optional[A
             logger.error(f"No enough permission. leaving @ {guild.name}")
             await guild.leave()
             del managers[guild]
+            del managers_by_id[guild.id]
             return None
     return manager
 
@@ -485,7 +584,7 @@ async def on_guild_join(guild: Guild):
 async def amongus(ctx: Context):
     manager = await get_manager(ctx.guild, ctx.author)
     if not manager:
-        await ctx.send(Localized.no_guild)
+        await ctx.send(get_locale().no_guild)
         return
     await manager.create_session(ctx.author, ctx.channel)
 
@@ -494,7 +593,7 @@ async def amongus(ctx: Context):
 async def help_command(ctx: Context):
     manager = await get_manager(ctx.guild, ctx.author)
     if not manager:
-        await ctx.send(Localized.no_guild)
+        await ctx.send(get_locale().no_guild)
         return
     await ctx.send(manager.locale.help_message)
 
@@ -503,9 +602,9 @@ async def help_command(ctx: Context):
 async def setting(ctx: Context, item: Optional[str] = None, new_value: Optional[str] = None):
     manager = await get_manager(ctx.guild, ctx.author)
     if not manager:
-        await ctx.send(Localized.no_guild)
+        await ctx.send(get_locale().no_guild)
         return
-    current_settings = {"locale": manager.locale.__class__.__name__.lower()}
+    current_settings = {"locale": manager.locale.name}
     if not item:
         await ctx.send("\n".join([f"{key}: {value}" for key, value in current_settings.items()]))
         return
@@ -522,6 +621,16 @@ async def setting(ctx: Context, item: Optional[str] = None, new_value: Optional[
 # VoiceState変更フック
 @bot.event
 async def on_voice_state_update(member: Member, before: VoiceState, after: VoiceState):
+    member_manager = managers_by_id.get(member.guild.id)
+    pending_move = member_manager and member_manager.pending_moves.get(member.id)
+    if pending_move:
+        pending_move.observe(voice_target(after))
+        if pending_move.parked and after.channel:
+            del member_manager.pending_moves[member.id]
+            session_id = member_manager.member_sessions_idx.get(member)
+            member_session = session_id and member_manager.sessions.get(session_id)
+            if member_session and member in member_session.members:
+                asyncio.create_task(member_session.converge("reconnect", [member]))
     lobbies: Dict[VoiceChannel, AmongUsSession] = {}
     for manager in managers.values():
         for session in manager.sessions.values():
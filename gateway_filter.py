@@ -0,0 +1,80 @@
+import logging
+from typing import Any, Callable, Dict
+
+from discord import Client
+
+logger = logging.getLogger("amongus_admin")
+
+
+class VoiceEventFilter:
+    """
+    drop VOICE_STATE_UPDATE payloads before discord.py dispatches them.
+
+    Dropped payloads still update the library's caches the way `ConnectionState.parse_voice_state_update`
+    of discord.py 1.6 does, so `member.voice`, `guild.get_member` and `guild.members` stay what the library
+    would hold for anyone who joins a session later (e.g. the admin on `/amongus`).
+    Only the event dispatch and our handler are skipped.
+    All the private API of discord.py this bot relies on for that is kept in this module.
+    """
+
+    event = "VOICE_STATE_UPDATE"
+    is_relevant: Callable[[Dict[str, Any]], bool]
+    dropped: int
+    processed: int
+
+    def __init__(self, is_relevant: Callable[[Dict[str, Any]], bool]):
+        self.is_relevant = is_relevant
+        self.dropped = 0
+        self.processed = 0
+
+    def install(self, client: Client):
+        """
+        wrap the gateway parser of the client's ConnectionState
+
+        :param client:
+        :return:
+        """
+        connection = client._connection
+        # shared with the gateway websocket
+        parsers = connection.parsers
+        parse = parsers[self.event]
+
+        def filtered_parse(data: Dict[str, Any]):
+            if not self.is_relevant(data):
+                self.dropped += 1
+                self.update_caches(connection, data)
+                return
+            self.processed += 1
+            return parse(data)
+
+        parsers[self.event] = filtered_parse
+        logger.info(f"Installed gateway filter for {self.event}")
+
+    @staticmethod
+    def update_caches(connection, data: Dict[str, Any]):
+        """
+        mirror of `ConnectionState.parse_voice_state_update` of discord.py 1.6 without the dispatch.
+        The bot's own voice state is never dropped, so the voice client part is left out.
+
+        :param connection: ConnectionState
+        :param data: VOICE_STATE_UPDATE payload
+        :return:
+        """
+        guild_id = data.get("guild_id")
+        guild = guild_id and connection._get_guild(int(guild_id))
+        if not guild:
+            return
+        channel_id = data.get("channel_id")
+        channel_id = channel_id and int(channel_id)
+        member, _before, _after = guild._update_voice_state(data, channel_id)
+        flags = connection.member_cache_flags
+        if member is None or not flags.voice:
+            return
+        if channel_id is None and flags._voice_only and member.id != connection.self_id:
+            # only the voice flag keeps the member cached
+            guild._remove_member(member)
+        elif channel_id is not None:
+            guild._add_member(member)
+
+    def stats(self) -> Dict[str, int]:
+        return {"dropped": self.dropped, "processed": self.processed}
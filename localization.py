@@ -1,55 +1,145 @@
-from bot_enum import ActionReaction
+import json
+import os
+from functools import lru_cache
+from typing import Dict, FrozenSet, Optional, Tuple
+
+from bot_enum import ActionReaction, AmongUsSessionPhase, AmongUsSessionStatus
+
+catalog_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "locales")
+default_locale = "english"
+locale_aliases = {
+    "en": "english",
+    "en-US": "english",
+    "en-GB": "english",
+    "ja": "japanese",
+    "ja_JP": "japanese",
+    "日本語": "japanese",
+}
+
+Panel = Tuple[str, FrozenSet[ActionReaction]]
+
+
+class _Placeholders(dict):
+    """keeps unknown `{placeholders}` as is, so they can be formatted later"""
+
+    def __missing__(self, key):
+        return f"{{{key}}}"
 
 
 class Localized:
-    lobby = "lobby"
-    emergency = "emergency"
-    mute = "mute"
-    graveyard = "graveyard"
-    controls = "[Controls]"
-    help_message = f"Hi! I'm AmongUs Admin bot. To start a AmongUs session, type `/amongus`."
-    need_permission_message = (
-        "I don't have enough permissions to manage an AmongUs Session!\n"
-        "Please invite me with the correct permissions with the following link\n\n"
-        "{invitation_link}"
-    )
-    error_message = "Oops, wrong command."
-    no_guild = "First, start or join a AmongUs session in a single Server!"
-    locale_set_message = "The Locale for the server is now: English"
-    new_session = (
-        "There's a new AmongUs session: `{session_id}`!\n" "Go to the lobby voice channel of the session to join!"
-    )
-    create_message = "Hi {name}! You created an AmongUs session: {session_id}."
-    ready_message = f"When ready, press `{ActionReaction.START}` to start the session!"
-    join_message = "Hi {name}! You joined an AmongUs session: {session_id}."
-    start_message_admin = (
-        f"Press `{ActionReaction.GATHER}` to start a emergency meeting, and `{ActionReaction.MUTE}` to end it!"
-    )
-    start_message = (
-        "Session {session_id} started!\n" f"Press `{ActionReaction.DEAD}` to tell me when you're ejected or dead"
-    )
-    dead_message = "(Oh no! I'll put you in the dead list then. Join the other party now...)"
-
-
-class English(Localized):
-    pass
-
-
-class Japanese(Localized):
-    lobby = "ロビー"
-    emergency = "緊急会議"
-    mute = "ミュート"
-    graveyard = "墓地"
-    controls = "[ボタン]"
-    help_message = f"こんにちは！AmongUs Adminボットです。AmongUsのセッションを作成するには、`/amongus`とタイプしてください！"
-    need_permission_message = "AmongUsを管理するための権限が足りません！\n" "下のリンクから招待を再度お試しください\n\n" "{invitation_link}"
-    error_message = "すみません、、わからないコマンドです。。"
-    no_guild = "まず、どこかのサーバーでAmongUsのセッションを開始または参加してください！"
-    locale_set_message = "サーバーの言語が変更されました！: 日本語"
-    new_session = "新しいAmongUsのセッション({session_id})が作成されました!\n" "参加したい人はロビーのボイスチャンネルに入ってください！"
-    create_message = "{name}やっほー! AmongUsのセッションを作成しました！: {session_id}"
-    ready_message = f"準備ができたら`{ActionReaction.START}`を押してセッションを開始してください！"
-    join_message = "{name}やっほー! AmongUsのセッションに参加しました！: {session_id}"
-    start_message_admin = f"`{ActionReaction.GATHER}`を押して会議開始、`{ActionReaction.MUTE}`を押して会議終了です。"
-    start_message = "{session_id}が開始されました！\n" f"追放されたり誰かに殺されたら、`{ActionReaction.DEAD}`を押して教えてください！"
-    dead_message = "(おおっと！そうしたら死亡者リストに登録しますね！こっち側も楽しいですよ。。)"
+    """
+    Messages of a single locale, loaded from `locales/<name>.json`.
+    Instances are shared between every guild using the locale, so they are immutable.
+    """
+
+    name: str
+    lobby: str
+    emergency: str
+    mute: str
+    graveyard: str
+    controls: str
+    help_message: str
+    need_permission_message: str
+    error_message: str
+    no_guild: str
+    locale_set_message: str
+    new_session: str
+    create_message: str
+    ready_message: str
+    join_message: str
+    start_message_admin: str
+    start_message: str
+    dead_message: str
+    _panels: Dict[Tuple[bool, AmongUsSessionPhase, Optional[AmongUsSessionStatus]], Panel]
+
+    def __init__(self, name: str, messages: Dict[str, str]):
+        reactions = _Placeholders({reaction.name: reaction.value for reaction in ActionReaction})
+        object.__setattr__(self, "name", name)
+        for key, message in messages.items():
+            object.__setattr__(self, key, message.format_map(reactions))
+        object.__setattr__(self, "_panels", {})
+
+    def __setattr__(self, key, value):
+        raise AttributeError(f"{self.__class__.__name__} is immutable")
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__} {self.name}>"
+
+    def render_panel(
+        self, is_admin: bool, phase: AmongUsSessionPhase, status: Optional[AmongUsSessionStatus]
+    ) -> Panel:
+        """
+        get the private message template and the reactions for a member.
+        The template still has `{name}` and `{session_id}` to be formatted by the caller.
+
+        :param is_admin: whether the member is the session admin
+        :param phase: current phase of the session
+        :param status: member's status (ignored in the lobby)
+        :return: (template, reactions)
+        """
+        if phase == AmongUsSessionPhase.LOBBY:
+            status = None
+        key = (is_admin, phase, status)
+        panel = self._panels.get(key)
+        if panel is None:
+            panel = self._panels[key] = self._build_panel(is_admin, phase, status)
+        return panel
+
+    def _build_panel(
+        self, is_admin: bool, phase: AmongUsSessionPhase, status: Optional[AmongUsSessionStatus]
+    ) -> Panel:
+        messages = [self.create_message if is_admin else self.join_message]
+        reactions = set()
+        if phase == AmongUsSessionPhase.LOBBY:
+            if is_admin:
+                messages.append(self.ready_message)
+                reactions.add(ActionReaction.START)
+                reactions.add(ActionReaction.CLOSE)
+        else:
+            messages.append(self.start_message)
+            if is_admin:
+                messages.append(self.start_message_admin)
+                is_emergency = phase == AmongUsSessionPhase.EMERGENCY
+                reactions.add(ActionReaction.MUTE if is_emergency else ActionReaction.GATHER)
+                reactions.add(ActionReaction.STOP)
+            if status == AmongUsSessionStatus.DEAD:
+                messages.append(self.dead_message)
+            else:
+                reactions.add(ActionReaction.DEAD)
+        return "\n".join(messages), frozenset(reactions)
+
+
+def _read_catalog(name: str) -> Dict[str, str]:
+    with open(os.path.join(catalog_dir, f"{name}.json"), encoding="utf-8") as f:
+        return json.load(f)
+
+
+@lru_cache(maxsize=None)
+def available_locales() -> FrozenSet[str]:
+    return frozenset(os.path.splitext(file)[0] for file in os.listdir(catalog_dir) if file.endswith(".json"))
+
+
+@lru_cache(maxsize=None)
+def load_locale(name: str) -> Localized:
+    """
+    load a catalog on the first use. Missing messages fall back to the default locale.
+
+    :param name: catalog name
+    :return:
+    """
+    messages = {} if name == default_locale else _read_catalog(default_locale)
+    messages.update(_read_catalog(name))
+    return Localized(name, messages)
+
+
+def get_locale(locale: Optional[str] = None) -> Localized:
+    """
+    get the shared Localized for a locale name, alias, or discord's preferred_locale
+
+    :param locale:
+    :return:
+    """
+    name = locale_aliases.get(locale, locale and locale.lower())
+    if name not in available_locales():
+        name = default_locale
+    return load_locale(name)
@@ -0,0 +1,227 @@
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+from discord import HTTPException, VoiceState
+
+logger = logging.getLogger("amongus_admin")
+
+# (channel id, mute, deafen)
+VoiceTarget = Tuple[Optional[int], bool, bool]
+# JSON error code of "Target user is not connected to voice."
+NOT_CONNECTED_TO_VOICE = 40032
+
+
+def voice_target(voice_state: Optional[VoiceState]) -> VoiceTarget:
+    if not voice_state or not voice_state.channel:
+        return None, False, False
+    return voice_state.channel.id, voice_state.mute, voice_state.deaf
+
+
+class VoiceMove:
+    """
+    a single member.edit job, confirmed by the following VOICE_STATE_UPDATE of the member.
+    While the member is not connected to voice (e.g. reconnecting), the job waits for them to come back.
+    """
+
+    retries: int = 3
+    timeout: float = 5.0
+    backoff: float = 0.5
+    reconnect_timeout: float = 30.0
+    member_id: int
+    target: VoiceTarget
+    attempts: int
+    superseded: bool
+    parked: bool
+    connected: asyncio.Event
+    confirmed: asyncio.Future
+
+    def __init__(self, member_id: int, target: VoiceTarget):
+        self.member_id = member_id
+        self.target = target
+        self.attempts = 0
+        self.superseded = False
+        self.parked = False
+        self.connected = asyncio.Event()
+        self.confirmed = asyncio.get_event_loop().create_future()
+
+    def matches(self, state: VoiceTarget) -> bool:
+        if self.target[0] is None:
+            return state[0] is None
+        return state == self.target
+
+    def observe(self, state: VoiceTarget):
+        """
+        feed a voice state of the member from the gateway
+
+        :param state:
+        :return:
+        """
+        if state[0] is None:
+            self.connected.clear()
+        else:
+            self.connected.set()
+        if not self.confirmed.done() and self.matches(state):
+            self.confirmed.set_result(True)
+
+    def supersede(self):
+        """
+        stop retrying because a newer move for the member was issued
+
+        :return:
+        """
+        self.superseded = True
+        if not self.confirmed.done():
+            self.confirmed.set_result(False)
+
+    async def run(
+        self, edit: Callable[[], Awaitable], current: Callable[[], VoiceTarget], on_sent: Callable[[], None]
+    ) -> bool:
+        """
+        call `edit` until the member's voice state converges to the target.
+        Rate limits and server errors are retried. When the member is not connected to voice,
+        the edit waits up to `reconnect_timeout` for them to come back. Other errors are final.
+
+        :param edit: sends the edit request
+        :param current: reads the cached voice state of the member
+        :param on_sent: called after every request or when starting to wait for a reconnect
+        :return: whether the target was reached
+        """
+        self.observe(current())
+        for attempt in range(self.retries + 1):
+            if attempt:
+                await asyncio.sleep(self.backoff * 2 ** (attempt - 1))
+            if self.confirmed.done():
+                return self.confirmed.result()
+            if not self.connected.is_set():
+                on_sent()
+                logger.info(f"voice move of {self.member_id} waits for the member to reconnect")
+                if not await self._wait_connected():
+                    return self.confirmed.done() and self.confirmed.result()
+            self.attempts += 1
+            try:
+                await edit()
+            except HTTPException as e:
+                if e.code == NOT_CONNECTED_TO_VOICE:
+                    self.connected.clear()
+                    continue
+                if e.status != 429 and e.status < 500:
+                    logger.warning(f"voice move of {self.member_id} gave up: {e}")
+                    return False
+                logger.warning(f"voice move of {self.member_id} failed (attempt {self.attempts}): {e}")
+                continue
+            finally:
+                on_sent()
+            try:
+                return await asyncio.wait_for(asyncio.shield(self.confirmed), self.timeout)
+            except asyncio.TimeoutError:
+                if self.matches(current()):
+                    return True
+                logger.warning(f"voice move of {self.member_id} not confirmed (attempt {self.attempts})")
+        return False
+
+    async def _wait_connected(self) -> bool:
+        connected = asyncio.ensure_future(self.connected.wait())
+        await asyncio.wait(
+            [connected, self.confirmed], timeout=self.reconnect_timeout, return_when=asyncio.FIRST_COMPLETED
+        )
+        connected.cancel()
+        return self.connected.is_set() and not self.confirmed.done()
+
+
+class TransitionReport:
+    """
+    time to convergence of the voice moves issued by a single session transition
+    """
+
+    name: str
+    started_at: float
+    finished_at: Optional[float]
+    members: Dict[int, float]
+    failed: List[int]
+    attempts: int
+    unsent: Set[int]
+    all_sent: asyncio.Event
+
+    def __init__(self, name: str, member_ids: Iterable[int]):
+        self.name = name
+        self.started_at = time.monotonic()
+        self.finished_at = None
+        self.members = {}
+        self.failed = []
+        self.attempts = 0
+        self.unsent = set(member_ids)
+        self.all_sent = asyncio.Event()
+        if not self.unsent:
+            self.all_sent.set()
+
+    def mark_sent(self, member_id: int):
+        """
+        the first edit request for the member was answered, or no request was needed
+
+        :param member_id:
+        :return:
+        """
+        self.unsent.discard(member_id)
+        if not self.unsent:
+            self.all_sent.set()
+
+    def record(self, member_id: int, move: VoiceMove, ok: bool):
+        self.attempts += move.attempts
+        if ok:
+            self.members[member_id] = time.monotonic() - self.started_at
+        else:
+            self.failed.append(member_id)
+
+    def finish(self):
+        self.finished_at = time.monotonic()
+
+    @property
+    def duration(self) -> Optional[float]:
+        if self.finished_at is None:
+            return None
+        return self.finished_at - self.started_at
+
+    def __str__(self):
+        members = ", ".join(f"{member_id}: {elapsed:.3f}s" for member_id, elapsed in self.members.items())
+        failed = f" failed: {', '.join(map(str, self.failed))}" if self.failed else ""
+        return f"{self.name} converged in {self.duration:.3f}s ({members}){failed}"
+
+
+class TransitionStats:
+    """
+    running totals of finished reports per transition name, without any member or guild identifiers.
+    Kept outside of sessions, so they survive sessions ending.
+    """
+
+    totals: Dict[str, Dict[str, float]]
+
+    def __init__(self):
+        self.totals = {}
+
+    def add(self, report: TransitionReport):
+        if report.duration is None:
+            return
+        stats = self.totals.setdefault(
+            report.name, {"count": 0, "total": 0.0, "max": 0.0, "members": 0, "failed": 0, "attempts": 0}
+        )
+        stats["count"] += 1
+        stats["total"] += report.duration
+        stats["max"] = max(stats["max"], report.duration)
+        stats["members"] += len(report.members) + len(report.failed)
+        stats["failed"] += len(report.failed)
+        stats["attempts"] += report.attempts
+
+    def as_dict(self) -> Dict[str, dict]:
+        return {
+            name: {
+                "count": stats["count"],
+                "mean": stats["total"] / stats["count"],
+                "max": stats["max"],
+                "members": stats["members"],
+                "failed": stats["failed"],
+                "attempts": stats["attempts"],
+            }
+            for name, stats in self.totals.items()
+        }